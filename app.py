@@ -1,20 +1,29 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
 import os
+import re
 import secrets
-import uuid
+import shutil
+import time
 import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from datetime import date
+from datetime import datetime
 
 from fastapi import FastAPI, UploadFile, File, Form, Request
-from fastapi.responses import HTMLResponse, Response, PlainTextResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, Response, PlainTextResponse, RedirectResponse, FileResponse
 
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.middleware.trustedhost import TrustedHostMiddleware
+from starlette.background import BackgroundTask
+from starlette.staticfiles import StaticFiles
 
 import stripe
 
-from clean_pdf import clean_pdf, compress_with_ghostscript
-from db import init_db, save_token, get_token, get_used, inc_used
+from clean_pdf import clean_pdf_to_bytes, scan_blank_pages, build_gs_command, build_page_list, GS_TIMEOUT
+from db import init_db, save_token, get_token, get_used, inc_used, flush_usage
 
 
 app = FastAPI(title="PDF Cleaner & Compressor")
@@ -41,6 +50,10 @@ STRIPE_PRICE_BUSINESS = os.getenv("STRIPE_PRICE_BUSINESS", "")  # legacy (antes
 if STRIPE_SECRET_KEY:
     stripe.api_key = STRIPE_SECRET_KEY
 
+# URLs de checkout: derivan solo de PUBLIC_BASE_URL, se montan una vez en import
+STRIPE_SUCCESS_URL = f"{PUBLIC_BASE_URL}/success?session_id={{CHECKOUT_SESSION_ID}}"
+STRIPE_CANCEL_URL = f"{PUBLIC_BASE_URL}/#precios"
+
 # =========
 # LIMITES (NUEVOS)
 # =========
@@ -53,118 +66,438 @@ BASIC_MONTHLY_LIMIT = 50
 PRO_MAX_MB = 100
 PRO_MONTHLY_LIMIT = 200
 
+# Tabla plan -> (max_mb, limite_mensual, nombre), montada una vez.
+# "business" es legacy y actúa como pro.
+PLAN_LIMITS = {
+    "basic": (BASIC_MAX_MB, BASIC_MONTHLY_LIMIT, "basic"),
+    "pro": (PRO_MAX_MB, PRO_MONTHLY_LIMIT, "pro"),
+    "business": (PRO_MAX_MB, PRO_MONTHLY_LIMIT, "pro"),
+}
+FREE_LIMITS = (FREE_MAX_MB, FREE_MONTHLY_LIMIT, "free")
+
+# Mensajes de límite pre-montados por plan (evita re-formatear en cada 4xx).
+_SIZE_LIMIT_MSG = {
+    "free": f"Has superado el límite Gratis ({FREE_MAX_MB} MB).",
+    "basic": f"Has superado el límite Básico ({BASIC_MAX_MB} MB).",
+    "pro": f"Has superado el límite Pro ({PRO_MAX_MB} MB).",
+}
+_MONTHLY_LIMIT_MSG = {
+    "free": f"Has alcanzado el límite Gratis ({FREE_MONTHLY_LIMIT} PDFs/mes).",
+    "basic": f"Has alcanzado el límite Básico ({BASIC_MONTHLY_LIMIT} PDFs/mes).",
+    "pro": f"Has alcanzado el límite Pro ({PRO_MONTHLY_LIMIT} PDFs/mes).",
+}
+
 # =========
 # FILES
 # =========
 BASE_DIR = Path(__file__).resolve().parent
 TEMPLATE_DIR = BASE_DIR / "templates"
+STATIC_DIR = BASE_DIR / "static"
+
+
+def _asset_url(name: str) -> str:
+    """
+    URL versionada por contenido (/static/x.css?v=<hash>): permite cachear
+    con immutable en el navegador y busting automático al desplegar cambios.
+    """
+    digest = hashlib.blake2b((STATIC_DIR / name).read_bytes(), digest_size=8).hexdigest()
+    return f"/static/{name}?v={digest}"
+
+
+# Cada cuánto se vuelcan los contadores de uso en memoria a SQLite
+USAGE_FLUSH_INTERVAL = 10  # segundos
+
+_flush_task = None
+
+_log = logging.getLogger("uvicorn.error")
+
+
+async def _usage_flush_loop():
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        # El loop tiene que sobrevivir a errores transitorios de SQLite
+        # (p.ej. busy_timeout agotado): si la excepción escapara, el task
+        # moriría en silencio y los deltas pendientes solo se volcarían ya
+        # por el umbral de incrementos — o se perderían en un crash.
+        try:
+            await asyncio.to_thread(flush_usage)
+        except Exception:
+            _log.exception("flush_usage falló; se reintenta en el próximo intervalo")
+
+
+# =========
+# RATE LIMIT (burst)
+# =========
+# Token bucket por (plan, clave) DELANTE de la cuota mensual: modela ráfagas
+# cortas con coste O(1) en memoria y cero DB. capacity = ráfaga permitida,
+# rate = tokens/segundo de recarga. Sustituye a la ventana fija de buckets:
+# no necesita tarea de rotación y el refill es continuo.
+_BUCKET_PARAMS = {
+    "free": (3.0, 1.0 / 60.0),    # ráfaga de 3, recarga 1/min
+    "basic": (6.0, 1.0 / 20.0),
+    "pro": (10.0, 1.0 / 10.0),
+    "guard": (30.0, 1.0),         # filtro grueso por IP en el middleware
+}
+# OrderedDict con evicción LRU O(1): vaciar el dict entero al llenarse
+# (el bound anterior) regalaba ráfaga nueva a todo el mundo a la vez y metía
+# una pausa O(N); ahora cae solo la entrada menos usada en cada inserción.
+_BUCKETS: "OrderedDict" = OrderedDict()  # (plan, clave) -> (tokens, ultimo_refill_monotonic)
+_BUCKETS_MAX = 50_000
+
+
+def _over_burst(plan_name: str, key: str) -> bool:
+    capacity, rate = _BUCKET_PARAMS[plan_name]
+    now = time.monotonic()
+    bucket_key = (plan_name, key)
+    tokens, last = _BUCKETS.get(bucket_key, (capacity, now))
+    tokens = min(capacity, tokens + (now - last) * rate)
+    over = tokens < 1.0
+    if not over:
+        tokens -= 1.0
+    _BUCKETS[bucket_key] = (tokens, now)
+    _BUCKETS.move_to_end(bucket_key)
+    if len(_BUCKETS) > _BUCKETS_MAX:
+        _BUCKETS.popitem(last=False)
+    return over
 
 
 @app.on_event("startup")
-def _startup():
+async def _startup():
+    global _flush_task, _CLEAN_POOL
     init_db()
+    _build_template_cache()
+    _init_tmp_pool()
+    CACHE_DIR.mkdir(exist_ok=True)
+    _CLEAN_POOL = ProcessPoolExecutor(max_workers=max(1, os.cpu_count() or 1))
+    _flush_task = asyncio.create_task(_usage_flush_loop())
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    if _flush_task:
+        _flush_task.cancel()
+    if _CLEAN_POOL:
+        _CLEAN_POOL.shutdown(wait=False, cancel_futures=True)
+    # Último volcado para no perder los incrementos del intervalo en curso
+    flush_usage()
 
 
 # =========
 # SECURITY MIDDLEWARE
 # =========
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        resp = await call_next(request)
+# Security headers (baratos y útiles), pre-codificados una vez al formato
+# ASGI (bytes). HSTS solo tiene sentido si vas siempre en HTTPS (Render sí).
+# No pasa nada por ponerlo.
+_SECURITY_HEADERS_LIST = [
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-frame-options", b"DENY"),
+    (b"referrer-policy", b"no-referrer"),
+    (b"permissions-policy", b"geolocation=(), microphone=(), camera=()"),
+    (b"strict-transport-security", b"max-age=15552000; includeSubDomains"),
+]
+
+
+class SecurityHeadersMiddleware:
+    """
+    Middleware ASGI puro: BaseHTTPMiddleware lanzaba un task + wrapper anyio
+    por request solo para añadir 5 headers constantes. Aquí envolvemos send
+    y los concatenamos al http.response.start directamente.
+    """
 
-        # Security headers (baratos y útiles)
-        resp.headers["X-Content-Type-Options"] = "nosniff"
-        resp.headers["X-Frame-Options"] = "DENY"
-        resp.headers["Referrer-Policy"] = "no-referrer"
-        resp.headers["Permissions-Policy"] = "geolocation=(), microphone=(), camera=()"
+    def __init__(self, app):
+        self.app = app
 
-        # HSTS solo tiene sentido si vas siempre en HTTPS (Render sí).
-        # No pasa nada por ponerlo.
-        resp.headers["Strict-Transport-Security"] = "max-age=15552000; includeSubDomains"
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-        return resp
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers") or []) + _SECURITY_HEADERS_LIST
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+_GUARD_429_BODY = "Demasiadas peticiones seguidas. Espera unos minutos.".encode("utf-8")
+_GUARD_429_HEADERS = [
+    (b"content-type", b"text/plain; charset=utf-8"),
+    (b"content-length", str(len(_GUARD_429_BODY)).encode("latin-1")),
+    (b"retry-after", b"30"),
+]
 
+# Tope plano-agnóstico de tamaño: el límite más alto de todos los planes.
+# Se aplica aquí (antes de que Starlette consuma el multipart) porque en el
+# handler el body YA está en el spool — un 413 allí no ahorra ni un byte de
+# subida. El límite fino por plan sigue en /process.
+_GUARD_MAX_BYTES = PRO_MAX_MB * 1024 * 1024
+_GUARD_413_BODY = f"El PDF supera el máximo admitido ({PRO_MAX_MB} MB).".encode("utf-8")
+_GUARD_413_HEADERS = [
+    (b"content-type", b"text/plain; charset=utf-8"),
+    (b"content-length", str(len(_GUARD_413_BODY)).encode("latin-1")),
+]
 
+
+class ProcessGuardMiddleware:
+    """
+    Filtro grueso por IP DELANTE del parseo multipart: el check fino por plan
+    de /process corre después de que Starlette haya consumido el body entero,
+    así que un abusador pagaba el coste del upload en cada 429. Aquí cortamos
+    por scope antes de leer un solo byte del body. El bucket "guard" es más
+    generoso que cualquier plan para no penalizar IPs compartidas (NAT).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/process" and scope["method"] == "POST":
+            # Se parsea una vez y se deja en el scope: el handler (y cualquier
+            # limitador futuro) la lee de ahí en vez de re-partir el header.
+            ip = _client_ip_from_scope(scope)
+            scope["client_ip"] = ip
+
+            if _over_burst("guard", ip):
+                await send({"type": "http.response.start", "status": 429, "headers": _GUARD_429_HEADERS})
+                await send({"type": "http.response.body", "body": _GUARD_429_BODY})
+                return
+
+            # Content-Length declarado contra el tope máximo: aquí el body
+            # aún no se ha leído, así que el cliente puede abortar el upload
+            # entero. Header falseado o ausente -> lo pilla el check en
+            # streaming del handler.
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    try:
+                        declared = int(value)
+                    except ValueError:
+                        declared = 0
+                    if declared > _GUARD_MAX_BYTES:
+                        await send({"type": "http.response.start", "status": 413, "headers": _GUARD_413_HEADERS})
+                        await send({"type": "http.response.body", "body": _GUARD_413_BODY})
+                        return
+                    break
+
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(ProcessGuardMiddleware)
 app.add_middleware(SecurityHeadersMiddleware)
 
+
+# =========
+# STATIC
+# =========
+class CachedStaticFiles(StaticFiles):
+    """
+    Las URLs llevan el hash del contenido (?v=...), así que el navegador
+    puede cachear para siempre: cualquier cambio genera otra URL.
+    """
+
+    def file_response(self, *args, **kwargs):
+        resp = super().file_response(*args, **kwargs)
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return resp
+
+
+app.mount("/static", CachedStaticFiles(directory=STATIC_DIR), name="static")
+
 # Trusted hosts opcional:
 # - Si defines ALLOWED_HOSTS, bloquea hosts raros (anti-ataques tontos).
 # - Ej: ALLOWED_HOSTS="tudominio.com,.tudominio.com,xxxx.onrender.com"
+# El import va dentro del if: si no se usa, no se carga.
 allowed_hosts_env = os.getenv("ALLOWED_HOSTS", "").strip()
 if allowed_hosts_env:
     allowed_hosts = [h.strip() for h in allowed_hosts_env.split(",") if h.strip()]
     if allowed_hosts:
+        from starlette.middleware.trustedhost import TrustedHostMiddleware
+
         app.add_middleware(TrustedHostMiddleware, allowed_hosts=allowed_hosts)
 
 
 # =========
 # HTML RENDER (replace seguro)
 # =========
+# En DEBUG=1 releemos plantillas del disco en cada request (dev).
+# En producción se precompilan una vez en startup.
+DEBUG = os.getenv("DEBUG", "") == "1"
+
+# Caches construidas en startup:
+# - _LANDING_HTML: landing ya sustituida y codificada (bytes listos para servir)
+# - _APP_TEMPLATE: app.html con las vars de negocio ya sustituidas;
+#   solo queda %%TOKEN%%/{TOKEN} por request.
+_LANDING_HTML: bytes = b""
+_LANDING_GZ: bytes = b""
+_LANDING_ETAG: str = ""
+_LANDING_HEADERS: dict = {}
+_LANDING_GZ_HEADERS: dict = {}
+_APP_TEMPLATE: str = ""
+
+# Headers constantes de los endpoints calientes (un dict por proceso,
+# Starlette los copia al montar cada Response)
+_VERSION_ETAG = f'"{APP_VERSION}"'
+_VERSION_HEADERS = {"Cache-Control": "public, max-age=60", "ETag": _VERSION_ETAG}
+_APP_PAGE_HEADERS = {"Cache-Control": "private, no-store"}
+
+
 def _read_template(name: str) -> str:
     p = TEMPLATE_DIR / name
     return p.read_text(encoding="utf-8")
 
 
+# Valores de negocio para las plantillas: son constantes de arranque,
+# el dict se monta una vez en import en lugar de por render.
+_TEMPLATE_VALUES = {
+    # FREE
+    "FREE_MONTHLY_LIMIT": str(FREE_MONTHLY_LIMIT),
+    "FREE_MAX_MB": str(FREE_MAX_MB),
+
+    # BASIC (5€)
+    "BASIC_MONTHLY_LIMIT": str(BASIC_MONTHLY_LIMIT),
+    "BASIC_MAX_MB": str(BASIC_MAX_MB),
+
+    # PRO (9€)
+    "PRO_MONTHLY_LIMIT": str(PRO_MONTHLY_LIMIT),
+    "PRO_MAX_MB": str(PRO_MAX_MB),
+
+    # Compatibilidad si tu HTML aún usa BUSINESS_*
+    "BUSINESS_MONTHLY_LIMIT": str(PRO_MONTHLY_LIMIT),
+    "BUSINESS_MAX_MB": str(PRO_MAX_MB),
+
+    "APP_VERSION": str(APP_VERSION),
+
+    # Assets estáticos con URL versionada por contenido
+    "APP_CSS_URL": _asset_url("app.css"),
+    "APP_JS_URL": _asset_url("app.js"),
+}
+
+
+# Regex compilada una vez: solo matchea claves conocidas, así que NO toca
+# llaves del CSS ni otros %%...%% que no sean nuestros.
+_VAR_RE = re.compile(
+    r"\{(" + "|".join(map(re.escape, _TEMPLATE_VALUES)) + r")\}"
+    r"|%%(" + "|".join(map(re.escape, _TEMPLATE_VALUES)) + r")%%"
+)
+
+
 def _apply_vars(html: str) -> str:
     """
     Sustituye placeholders de negocio en DOS formatos:
       {KEY}
       %%KEY%%
-    y NO toca llaves del CSS.
+    en una sola pasada (antes eran 2 str.replace por clave = ~18 pasadas).
     """
-    values = {
-        # FREE
-        "FREE_MONTHLY_LIMIT": str(FREE_MONTHLY_LIMIT),
-        "FREE_MAX_MB": str(FREE_MAX_MB),
-
-        # BASIC (5€)
-        "BASIC_MONTHLY_LIMIT": str(BASIC_MONTHLY_LIMIT),
-        "BASIC_MAX_MB": str(BASIC_MAX_MB),
-
-        # PRO (9€)
-        "PRO_MONTHLY_LIMIT": str(PRO_MONTHLY_LIMIT),
-        "PRO_MAX_MB": str(PRO_MAX_MB),
-
-        # Compatibilidad si tu HTML aún usa BUSINESS_*
-        "BUSINESS_MONTHLY_LIMIT": str(PRO_MONTHLY_LIMIT),
-        "BUSINESS_MAX_MB": str(PRO_MAX_MB),
-
-        "APP_VERSION": str(APP_VERSION),
+    return _VAR_RE.sub(lambda m: _TEMPLATE_VALUES[m.group(1) or m.group(2)], html)
+
+
+def _build_template_cache():
+    global _LANDING_HTML, _LANDING_GZ, _LANDING_ETAG, _LANDING_HEADERS, _LANDING_GZ_HEADERS
+    global _APP_TEMPLATE
+    _LANDING_HTML = _apply_vars(_read_template("landing.html")).encode("utf-8")
+    # gzip al máximo: se paga una vez aquí, no por request (nada de
+    # GZipMiddleware, que recomprimiría en cada GET)
+    _LANDING_GZ = gzip.compress(_LANDING_HTML, 9)
+    _LANDING_ETAG = f'"{hashlib.blake2b(_LANDING_HTML, digest_size=16).hexdigest()}"'
+    _LANDING_HEADERS = {
+        "ETag": _LANDING_ETAG,
+        "Cache-Control": "public, max-age=300",
+        "Vary": "Accept-Encoding",
     }
-
-    for key, val in values.items():
-        html = html.replace(f"{{{key}}}", val)   # {KEY}
-        html = html.replace(f"%%{key}%%", val)   # %%KEY%%
-    return html
+    _LANDING_GZ_HEADERS = _LANDING_HEADERS | {"Content-Encoding": "gzip"}
+    _APP_TEMPLATE = _apply_vars(_read_template("app.html"))
 
 
-def render_landing_html() -> str:
-    return _apply_vars(_read_template("landing.html"))
+def render_landing_html() -> bytes:
+    if DEBUG or not _LANDING_HTML:
+        _build_template_cache()
+    return _LANDING_HTML
 
 
 def render_app_html(token: str = "") -> str:
     """
     Renderiza app.html y, si hay token, lo inyecta para que el formulario pueda enviarlo.
     En app.html puedes usar %%TOKEN%% o {TOKEN}.
+
+    Las vars de negocio ya vienen sustituidas desde la cache de startup:
+    aquí solo se reemplaza el token por request.
     """
-    html = _apply_vars(_read_template("app.html"))
+    if DEBUG or not _APP_TEMPLATE:
+        _build_template_cache()
     token = token or ""
-    html = html.replace("%%TOKEN%%", token).replace("{TOKEN}", token)
-    return html
+    return _APP_TEMPLATE.replace("%%TOKEN%%", token).replace("{TOKEN}", token)
 
 
 # =========
 # UTILS
 # =========
+def _client_ip_from_scope(scope) -> str:
+    for name, value in scope["headers"]:
+        if name == b"x-forwarded-for":
+            return value.decode("latin-1").split(",", 1)[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
 def get_client_ip(request: Request) -> str:
-    xff = request.headers.get("x-forwarded-for")
-    if xff:
-        return xff.split(",")[0].strip()
-    return request.client.host if request.client else "unknown"
+    # El middleware de guardia ya la resolvió y la dejó en el scope; si la
+    # request no pasó por él (otras rutas), la parseamos una vez y la cacheamos.
+    ip = request.scope.get("client_ip")
+    if ip is None:
+        ip = _client_ip_from_scope(request.scope)
+        request.scope["client_ip"] = ip
+    return ip
+
+
+# month_str() está en el path caliente de /process y su valor solo cambia una
+# vez al mes: cacheamos por día epoch y solo re-formateamos al cambiar de día.
+# Todo en UTC — clave, valor y el Retry-After de abajo salen del mismo reloj;
+# mezclar epoch UTC con date.today() local servía el mes viejo durante el
+# offset del TZ tras el cambio de mes.
+_MONTH_CACHE = (-1, "")  # (dia_epoch_utc, "YYYY-MM")
+
+
+def _month_retry_after() -> str:
+    """Segundos (UTC) hasta el día 1 del mes siguiente, para Retry-After."""
+    now = datetime.utcnow()
+    nxt = datetime(now.year + (now.month == 12), (now.month % 12) + 1, 1)
+    return str(int((nxt - now).total_seconds()))
 
 
 def month_str() -> str:
-    return date.today().strftime("%Y-%m")
+    global _MONTH_CACHE
+    now = time.time()
+    day = int(now // 86400)
+    if day != _MONTH_CACHE[0]:
+        _MONTH_CACHE = (day, time.strftime("%Y-%m", time.gmtime(now)))
+    return _MONTH_CACHE[1]
+
+
+# Cache TTL de tokens: el plan de un token casi nunca cambia, así que nos
+# ahorramos el viaje a SQLite en cada /process del mismo usuario de pago.
+# Los fallos (token inválido) se cachean con TTL corto para no amplificar probes.
+_TOKEN_CACHE: "OrderedDict" = OrderedDict()  # token -> (expira_monotonic, row | None)
+_TOKEN_CACHE_MAX = 10_000
+_TOKEN_TTL = 60.0
+_TOKEN_NEG_TTL = 10.0
+
+
+def _get_token_cached(token: str):
+    now = time.monotonic()
+    hit = _TOKEN_CACHE.get(token)
+    if hit is not None and hit[0] > now:
+        _TOKEN_CACHE.move_to_end(token)
+        return hit[1]
+
+    row = get_token(token)
+
+    # Evicción LRU: un spray de tokens inválidos expulsa entradas frías de una
+    # en una en vez de vaciar la cache de los usuarios legítimos de golpe.
+    _TOKEN_CACHE[token] = (now + (_TOKEN_TTL if row else _TOKEN_NEG_TTL), row)
+    _TOKEN_CACHE.move_to_end(token)
+    if len(_TOKEN_CACHE) > _TOKEN_CACHE_MAX:
+        _TOKEN_CACHE.popitem(last=False)
+    return row
 
 
 def plan_limits_for_token(token: str):
@@ -173,24 +506,21 @@ def plan_limits_for_token(token: str):
     Si no hay token válido -> Free.
     """
     if token:
-        row = get_token(token)
+        row = _get_token_cached(token)
         if row:
-            plan = (row["plan"] or "").lower().strip()
-            if plan == "basic":
-                return BASIC_MAX_MB, BASIC_MONTHLY_LIMIT, "basic"
-            if plan == "pro":
-                return PRO_MAX_MB, PRO_MONTHLY_LIMIT, "pro"
+            plan = (row.plan or "").lower().strip()
+            limits = PLAN_LIMITS.get(plan)
+            if limits:
+                return limits
 
-            # compatibilidad legacy (si hay tokens antiguos "business")
-            if plan == "business":
-                return PRO_MAX_MB, PRO_MONTHLY_LIMIT, "pro"
-
-    return FREE_MAX_MB, FREE_MONTHLY_LIMIT, "free"
+    return FREE_LIMITS
 
 
 def create_access_token(plan: str, email: str = "") -> str:
     t = secrets.token_urlsafe(24)
     save_token(token=t, plan=plan, email=email or "")
+    # Por si un probe cacheó este token como inválido justo antes del alta
+    _TOKEN_CACHE.pop(t, None)
     return t
 
 
@@ -202,77 +532,142 @@ def _ensure_stripe_ready():
     return ""
 
 
+# Solo depende de env vars leídas en import: evaluar una vez, no por checkout
+STRIPE_MISSING = _ensure_stripe_ready()
+
+
 # =========
 # ROUTES
 # =========
-@app.get("/version", response_class=PlainTextResponse)
-def version():
-    return APP_VERSION
-
-
-@app.get("/", response_class=HTMLResponse)
-def landing():
-    return render_landing_html()
+# Respuesta única pre-montada: el valor solo cambia al desplegar, así que no
+# hay que construir un PlainTextResponse (+ re-render de headers) por request.
+_VERSION_RESPONSE = PlainTextResponse(APP_VERSION, headers=_VERSION_HEADERS)
+
+
+@app.get("/version")
+async def version(request: Request):
+    # max-age corto: cambia solo al desplegar. El ETag es la propia versión,
+    # así las revalidaciones pasado el max-age vuelven como 304 sin body.
+    if request.headers.get("if-none-match") == _VERSION_ETAG:
+        return Response(status_code=304, headers=_VERSION_HEADERS)
+    return _VERSION_RESPONSE
+
+
+@app.get("/")
+async def landing(request: Request):
+    # ETag fuerte (hash del HTML precompilado): los repeat visitors reciben
+    # un 304 vacío en vez de re-descargar toda la landing. El body son bytes
+    # precompilados, sin encode por request.
+    html = render_landing_html()
+    # El 304 repite ETag/Cache-Control/Vary (RFC 9110: el 304 debe llevar los
+    # headers que se enviarían en un 200), igual que hace el de /version.
+    if request.headers.get("if-none-match") == _LANDING_ETAG:
+        return Response(status_code=304, headers=_LANDING_HEADERS)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(
+            content=_LANDING_GZ,
+            media_type="text/html; charset=utf-8",
+            headers=_LANDING_GZ_HEADERS,
+        )
+    return HTMLResponse(html, headers=_LANDING_HEADERS)
 
 
 @app.get("/free")
-def go_free():
+async def go_free():
     return RedirectResponse(url="/app", status_code=303)
 
 
 @app.get("/try")
-def go_try():
+async def go_try():
     return RedirectResponse(url="/app", status_code=303)
 
 
-@app.get("/app", response_class=HTMLResponse)
-def app_page(token: str = ""):
-    return HTMLResponse(render_app_html(token=token))
+@app.get("/app")
+async def app_page(token: str = ""):
+    # private/no-store: el HTML puede llevar el token embebido
+    return HTMLResponse(render_app_html(token=token), headers=_APP_PAGE_HEADERS)
 
 
 # =========
 # STRIPE CHECKOUT
 # =========
+# El doble-click en "Suscribirse" es habitual: con un nonce en cookie +
+# idempotency key no creamos dos sesiones en Stripe, y una cache corta de
+# (price, nonce) -> url convierte el re-click inmediato en redirect sin RTT.
+_CHECKOUT_CACHE: dict = {}  # (price_id, nonce) -> (expira_monotonic, url)
+_CHECKOUT_CACHE_MAX = 1_000
+_CHECKOUT_TTL = 60.0
+
+
+def _create_checkout_session(price_id: str, request: Request):
+    """
+    Crea (o reutiliza) la sesión de checkout para este navegador.
+    Devuelve (url, nonce_nuevo | None); si hay nonce nuevo hay que setearlo
+    como cookie en la respuesta.
+    """
+    nonce = request.cookies.get("checkout_nonce") or ""
+    now = time.monotonic()
+
+    if nonce:
+        hit = _CHECKOUT_CACHE.get((price_id, nonce))
+        if hit is not None and hit[0] > now:
+            return hit[1], None
+
+    new_nonce = None
+    if not nonce:
+        nonce = new_nonce = secrets.token_hex(16)
+
+    session = stripe.checkout.Session.create(
+        mode="subscription",
+        line_items=[{"price": price_id, "quantity": 1}],
+        success_url=STRIPE_SUCCESS_URL,
+        cancel_url=STRIPE_CANCEL_URL,
+        idempotency_key=f"checkout-{price_id}-{nonce}",
+    )
+
+    if len(_CHECKOUT_CACHE) >= _CHECKOUT_CACHE_MAX:
+        # Evicción selectiva en vez de clear(): vaciarlo entero dejaba sin
+        # cache a todos los navegadores a la vez (mismo defecto que tenían
+        # los buckets). Primero fuera lo caducado; si no había nada caducado,
+        # cae la entrada más antigua (TTL fijo + orden de inserción del dict:
+        # la primera es siempre la que antes expira).
+        expired = [k for k, v in _CHECKOUT_CACHE.items() if v[0] <= now]
+        for k in expired:
+            del _CHECKOUT_CACHE[k]
+        if len(_CHECKOUT_CACHE) >= _CHECKOUT_CACHE_MAX:
+            del _CHECKOUT_CACHE[next(iter(_CHECKOUT_CACHE))]
+    _CHECKOUT_CACHE[(price_id, nonce)] = (now + _CHECKOUT_TTL, session.url)
+    return session.url, new_nonce
+
+
+def _checkout_redirect(price_id: str, request: Request):
+    url, new_nonce = _create_checkout_session(price_id, request)
+    resp = RedirectResponse(url, status_code=303)
+    if new_nonce:
+        resp.set_cookie("checkout_nonce", new_nonce, max_age=600, httponly=True, samesite="lax")
+    return resp
+
+
 @app.get("/checkout/basic")
 def checkout_basic(request: Request):
-    missing = _ensure_stripe_ready()
-    if missing or not STRIPE_PRICE_BASIC:
+    if STRIPE_MISSING or not STRIPE_PRICE_BASIC:
         return HTMLResponse(
-            f"❌ Stripe no está configurado. Revisa {missing or 'STRIPE_PRICE_BASIC'}.",
+            f"❌ Stripe no está configurado. Revisa {STRIPE_MISSING or 'STRIPE_PRICE_BASIC'}.",
             status_code=500,
         )
 
-    success_url = f"{PUBLIC_BASE_URL}/success?session_id={{CHECKOUT_SESSION_ID}}"
-    cancel_url = f"{PUBLIC_BASE_URL}/#precios"
-
-    session = stripe.checkout.Session.create(
-        mode="subscription",
-        line_items=[{"price": STRIPE_PRICE_BASIC, "quantity": 1}],
-        success_url=success_url,
-        cancel_url=cancel_url,
-    )
-    return RedirectResponse(session.url, status_code=303)
+    return _checkout_redirect(STRIPE_PRICE_BASIC, request)
 
 
 @app.get("/checkout/pro")
 def checkout_pro(request: Request):
-    missing = _ensure_stripe_ready()
-    if missing or not STRIPE_PRICE_PRO:
+    if STRIPE_MISSING or not STRIPE_PRICE_PRO:
         return HTMLResponse(
-            f"❌ Stripe no está configurado. Revisa {missing or 'STRIPE_PRICE_PRO'}.",
+            f"❌ Stripe no está configurado. Revisa {STRIPE_MISSING or 'STRIPE_PRICE_PRO'}.",
             status_code=500,
         )
 
-    success_url = f"{PUBLIC_BASE_URL}/success?session_id={{CHECKOUT_SESSION_ID}}"
-    cancel_url = f"{PUBLIC_BASE_URL}/#precios"
-
-    session = stripe.checkout.Session.create(
-        mode="subscription",
-        line_items=[{"price": STRIPE_PRICE_PRO, "quantity": 1}],
-        success_url=success_url,
-        cancel_url=cancel_url,
-    )
-    return RedirectResponse(session.url, status_code=303)
+    return _checkout_redirect(STRIPE_PRICE_PRO, request)
 
 
 # Backward compatibility: si tu landing todavía llama a /checkout/business
@@ -281,20 +676,10 @@ def checkout_business_legacy(request: Request):
     # Si tienes el viejo PRICE_BUSINESS puesto, lo usamos como PRO para no romper.
     if STRIPE_PRICE_BUSINESS and not STRIPE_PRICE_PRO:
         # Caso legacy: el business antiguo actuará como PRO.
-        missing = _ensure_stripe_ready()
-        if missing:
-            return HTMLResponse(f"❌ Stripe no está configurado. Revisa {missing}.", status_code=500)
-
-        success_url = f"{PUBLIC_BASE_URL}/success?session_id={{CHECKOUT_SESSION_ID}}"
-        cancel_url = f"{PUBLIC_BASE_URL}/#precios"
-
-        session = stripe.checkout.Session.create(
-            mode="subscription",
-            line_items=[{"price": STRIPE_PRICE_BUSINESS, "quantity": 1}],
-            success_url=success_url,
-            cancel_url=cancel_url,
-        )
-        return RedirectResponse(session.url, status_code=303)
+        if STRIPE_MISSING:
+            return HTMLResponse(f"❌ Stripe no está configurado. Revisa {STRIPE_MISSING}.", status_code=500)
+
+        return _checkout_redirect(STRIPE_PRICE_BUSINESS, request)
 
     # Si no, redirigimos al PRO nuevo.
     return RedirectResponse(url="/checkout/pro", status_code=303)
@@ -356,9 +741,215 @@ async def stripe_webhook(request: Request):
     return Response(status_code=200)
 
 
+# =========
+# RESULT CACHE
+# =========
+# Cache en disco direccionada por contenido: SHA-256(upload) + calidad.
+# El mismo PDF subido dos veces (plantilla típica, o el "descárgalo otra vez")
+# se sirve sin pasar por pypdf ni Ghostscript. El hash se calcula mientras el
+# upload se escribe a disco, así que no hay pasada extra sobre el fichero.
+CACHE_DIR = BASE_DIR / "cache"
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def _cache_paths(digest: str, quality: str):
+    stem = f"{digest}_{quality}"
+    return CACHE_DIR / f"{stem}.pdf", CACHE_DIR / f"{stem}.json"
+
+
+def _cache_lookup(digest: str, quality: str):
+    """Devuelve (ruta_pdf, stats) si hay hit, si no None."""
+    pdf_path, meta_path = _cache_paths(digest, quality)
+    try:
+        stats = json.loads(meta_path.read_text())
+        if not pdf_path.exists():
+            return None
+    except (OSError, ValueError):
+        return None
+    now = time.time()
+    os.utime(pdf_path, (now, now))  # marca de uso para la evicción LRU
+    return pdf_path, stats
+
+
+def _cache_store(outp: Path, digest: str, quality: str, stats: dict):
+    pdf_path, meta_path = _cache_paths(digest, quality)
+    tmp_path = pdf_path.with_suffix(".tmp")
+    try:
+        try:
+            os.link(outp, tmp_path)
+        except OSError:
+            # cross-device (slot en /dev/shm, cache en disco): copiamos
+            shutil.copyfile(outp, tmp_path)
+        os.replace(tmp_path, pdf_path)  # atómico: nunca se ve un PDF a medias
+        meta_path.write_text(json.dumps(stats))
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+        return
+    _cache_evict()
+
+
+def _cache_evict():
+    """Si la cache pasa del cap, borra pares pdf+json de más viejo uso."""
+    entries = []
+    total = 0
+    for p in CACHE_DIR.glob("*.pdf"):
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+        total += st.st_size
+    if total <= CACHE_MAX_BYTES:
+        return
+    entries.sort()  # mtime ascendente = menos usado primero
+    for _, size, p in entries:
+        p.unlink(missing_ok=True)
+        p.with_suffix(".json").unlink(missing_ok=True)
+        total -= size
+        if total <= CACHE_MAX_BYTES:
+            break
+
+
+# =========
+# TMP POOL
+# =========
+# Pool de directorios de trabajo reutilizables, en /dev/shm si existe (tmpfs:
+# el scratch no toca disco). Se crean una vez en startup; cada request alquila
+# un slot vía Queue (backpressure natural si todos están ocupados) y al
+# devolverlo solo se borran los ficheros — nada de mkdtemp/rmtree por request.
+_TMP_POOL_SIZE = max(2, (os.cpu_count() or 1) * 2)
+_TMP_POOL: asyncio.Queue = None
+
+
+def _tmp_pool_base() -> Path:
+    shm = Path("/dev/shm")
+    base = shm if shm.is_dir() else Path(tempfile.gettempdir())
+    return base / "pdfcleaner"
+
+
+def _clear_slot(slot: Path):
+    for p in slot.iterdir():
+        p.unlink(missing_ok=True)
+
+
+def _init_tmp_pool():
+    global _TMP_POOL
+    _TMP_POOL = asyncio.Queue()
+    base = _tmp_pool_base()
+    base.mkdir(parents=True, exist_ok=True)
+    for i in range(_TMP_POOL_SIZE):
+        slot = base / f"slot-{i}"
+        slot.mkdir(exist_ok=True)
+        _clear_slot(slot)  # restos de un arranque anterior
+        _TMP_POOL.put_nowait(slot)
+
+
+async def _release_slot(slot: Path):
+    # Corre como BackgroundTask async (en el event loop), así el put_nowait
+    # sobre la Queue es seguro.
+    _clear_slot(slot)
+    _TMP_POOL.put_nowait(slot)
+
+
+def _size_limit_response(plan_name: str) -> PlainTextResponse:
+    return PlainTextResponse(_SIZE_LIMIT_MSG.get(plan_name, _SIZE_LIMIT_MSG["pro"]), status_code=413)
+
+
+def _process_headers(stats: dict, original_bytes: int, final_bytes: int) -> dict:
+    # % reducción (string compartido "0.0" para el caso vacío)
+    if original_bytes <= 0:
+        reduction_pct = "0.0"
+    else:
+        reduction_pct = format(max(0.0, (1.0 - (final_bytes / original_bytes)) * 100.0), ".1f")
+
+    return _PROCESS_BASE_HEADERS | {
+        "X-Total-Pages": str(stats.get("total", "")),
+        "X-Removed-Pages": str(stats.get("removed", "")),
+        "X-Input-Bytes": str(original_bytes),
+        "X-Output-Bytes": str(final_bytes),
+        "X-Reduction-Pct": reduction_pct,
+        # "none" = gs se saltó (PDF diminuto) o su salida era mayor que la
+        # entrada; el front puede mostrar "ya estaba optimizado" sin otro viaje.
+        "X-Compression-Applied": stats.get("compressor", "ghostscript"),
+    }
+
+
 # =========
 # PDF PROCESS
 # =========
+# Máximo de Ghostscript simultáneos: sin esto, una ráfaga de uploads
+# lanzaría un proceso gs por request y tumbaría el worker.
+_GS_SEMAPHORE = asyncio.Semaphore(max(1, os.cpu_count() or 1))
+
+# clean_pdf (pypdf) es CPU puro: en el thread pool compite por el GIL con
+# el resto del worker, así que va a un pool de procesos acotado a los cores.
+_CLEAN_POOL: ProcessPoolExecutor = None
+
+# Parte constante de los headers de respuesta de /process; los campos
+# dinámicos se añaden encima con un solo merge.
+_PROCESS_BASE_HEADERS = {
+    "Cache-Control": "no-store",
+    "Pragma": "no-cache",
+    # Los streams internos del PDF ya van en FlateDecode: recomprimir en HTTP
+    # es CPU tirada, y el identity explícito se lo dice a cualquier proxy.
+    "Content-Encoding": "identity",
+}
+
+# Calidades aceptadas desde el formulario (hoisted: antes se construía el set
+# en cada request)
+_ALLOWED_QUALITIES = frozenset({"screen", "ebook", "printer"})
+
+# Por debajo de este tamaño no merece la pena lanzar Ghostscript: su arranque
+# domina la latencia y en PDFs tan pequeños apenas hay nada que recomprimir.
+_GS_MIN_BYTES = 64 * 1024
+
+
+async def compress_with_ghostscript_async(input_src, output_pdf: str, quality: str, page_list: str = "") -> None:
+    """
+    Igual que clean_pdf.compress_with_ghostscript pero sin bloquear el event
+    loop: el subprocess se espera de forma asíncrona.
+
+    input_src puede ser bytes (el PDF entra por stdin) o una ruta (gs lee el
+    fichero directamente). Desde la fusión con -sPageList el pipeline de
+    /process pasa siempre la ruta del input; la rama de bytes queda como
+    capacidad soportada (p.ej. para alimentar a gs un PDF generado en
+    memoria) aunque hoy no tiene llamantes. Con page_list, gs procesa solo
+    esas páginas: el borrado de blancos y la compresión salen de la misma
+    pasada. La salida va a disco para poder responder en streaming con
+    FileResponse.
+    """
+    if isinstance(input_src, bytes):
+        cmd = build_gs_command("-", output_pdf, quality, page_list or None)
+        data = input_src
+    else:
+        cmd = build_gs_command(str(input_src), output_pdf, quality, page_list or None)
+        data = None
+
+    async with _GS_SEMAPHORE:
+        # stdout a /dev/null: con -dQUIET y la salida a fichero no lleva nada,
+        # y así nos ahorramos un pipe y su lectura por invocación.
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(data), timeout=GS_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise RuntimeError(
+                "Ghostscript tardó demasiado (timeout). Prueba con otra calidad o un PDF más pequeño."
+            )
+
+    if proc.returncode != 0:
+        raise RuntimeError(
+            "Ghostscript falló al comprimir.\n"
+            f"STDERR:\n{stderr.decode(errors='replace')}\n"
+        )
+
+
 @app.post("/process")
 async def process(
     request: Request,
@@ -366,14 +957,14 @@ async def process(
     quality: str = Form("screen"),
     token: str = Form(""),
 ):
-    # 1) Validación extensión
+    # 1) Validación extensión (solo miramos los últimos 4 chars, sin lower()
+    # de todo el nombre)
     filename = (file.filename or "").strip()
-    if not filename.lower().endswith(".pdf"):
-        return HTMLResponse("❌ Solo se aceptan PDFs.", status_code=400)
+    if filename[-4:].lower() != ".pdf":
+        return PlainTextResponse("❌ Solo se aceptan PDFs.", status_code=400)
 
     # 2) Calidad
-    allowed_qualities = {"screen", "ebook", "printer"}
-    if quality not in allowed_qualities:
+    if quality not in _ALLOWED_QUALITIES:
         quality = "screen"
 
     # 3) Plan + límites
@@ -387,75 +978,155 @@ async def process(
         key_type = "token"
         key_value = token
 
+    # Corta ráfagas (cualquier plan) ANTES de tocar SQLite
+    if _over_burst(plan_name, key_value):
+        return PlainTextResponse(
+            "Demasiadas peticiones seguidas. Espera unos minutos.",
+            status_code=429,
+            headers={"Retry-After": "60"},
+        )
+
     used = get_used(key_type, key_value, m)
     if used >= monthly_limit:
-        if plan_name == "free":
-            return HTMLResponse(f"Has alcanzado el límite Gratis ({FREE_MONTHLY_LIMIT} PDFs/mes).", status_code=429)
-        if plan_name == "basic":
-            return HTMLResponse(f"Has alcanzado el límite Básico ({BASIC_MONTHLY_LIMIT} PDFs/mes).", status_code=429)
-        return HTMLResponse(f"Has alcanzado el límite Pro ({PRO_MONTHLY_LIMIT} PDFs/mes).", status_code=429)
-
-    # 4) Tamaño max
-    data_in = await file.read()
-    original_bytes = len(data_in)
-
-    if original_bytes > max_mb * 1024 * 1024:
-        if plan_name == "free":
-            return HTMLResponse(f"Has superado el límite Gratis ({FREE_MAX_MB} MB).", status_code=413)
-        if plan_name == "basic":
-            return HTMLResponse(f"Has superado el límite Básico ({BASIC_MAX_MB} MB).", status_code=413)
-        return HTMLResponse(f"Has superado el límite Pro ({PRO_MAX_MB} MB).", status_code=413)
-
-    job_id = str(uuid.uuid4())
-    stats = {"total": "", "removed": ""}
+        return PlainTextResponse(
+            _MONTHLY_LIMIT_MSG.get(plan_name, _MONTHLY_LIMIT_MSG["pro"]),
+            status_code=429,
+            headers={"Retry-After": _month_retry_after()},
+        )
+
+    max_bytes = max_mb * 1024 * 1024
 
-    # Procesamos en carpeta temporal (se borra sola al terminar)
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdir = Path(tmpdir)
-        inp = tmpdir / f"{job_id}_input.pdf"
-        cleaned = tmpdir / f"{job_id}_cleaned.pdf"
-        outp = tmpdir / f"{job_id}_output.pdf"
+    # Refinamiento por plan del Content-Length declarado. OJO: aquí FastAPI
+    # ya consumió el multipart al spool (File(...) corre antes que el
+    # handler); el corte pre-body de verdad es el tope plano-agnóstico del
+    # ProcessGuardMiddleware. Este check solo evita abrir el spool para un
+    # fichero que el plan no admite.
+    try:
+        declared = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        declared = 0
+    if declared > max_bytes:
+        return _size_limit_response(plan_name)
 
-        inp.write_bytes(data_in)
+    stats = {"total": "", "removed": ""}
+
+    # Alquilamos un slot del pool (el fichero de salida tiene que sobrevivir
+    # hasta que la respuesta se envíe: la devolución va en un BackgroundTask).
+    tmpdir = await _TMP_POOL.get()
+    sent = False
+    try:
+        # Nombres fijos: la carpeta mkdtemp ya es única por request,
+        # no hace falta un uuid por fichero.
+        inp = tmpdir / "input.pdf"
+        outp = tmpdir / "output.pdf"
+
+        # 4) Copia en streaming del spool a disco (1 MB por chunk): no
+        # materializamos el PDF entero en RAM y devolvemos 413 en cuanto el
+        # tamaño real supera el límite del plan (el upload en sí ya terminó:
+        # esto lee del spool de Starlette, no del socket). De paso vamos
+        # hasheando los chunks (los bytes están calientes en L1).
+        original_bytes = 0
+        hasher = hashlib.sha256()
+        with open(inp, "wb") as f:
+            while chunk := await file.read(1 << 20):
+                # Magic bytes en el primer chunk: un binario renombrado a .pdf
+                # se rechaza en microsegundos en vez de quemar segundos de gs.
+                if original_bytes == 0 and not chunk.startswith(b"%PDF-"):
+                    return PlainTextResponse("❌ El archivo no es un PDF válido.", status_code=415)
+                original_bytes += len(chunk)
+                if original_bytes > max_bytes:
+                    return _size_limit_response(plan_name)
+                hasher.update(chunk)
+                f.write(chunk)
+        # Fichero vacío: el sniff de arriba solo corre si hubo algún chunk,
+        # así que sin este check un upload de 0 bytes acababa en PdfReader
+        # con un 500 en vez del 415 de "esto no es un PDF".
+        if original_bytes == 0:
+            return PlainTextResponse("❌ El archivo no es un PDF válido.", status_code=415)
+        # Libera el spool del UploadFile cuanto antes (no esperamos al GC)
+        await file.close()
+
+        # 4b) Hit de cache por contenido: mismo PDF + misma calidad ya
+        # procesados -> servimos el resultado cacheado sin clean ni gs.
+        digest = hasher.hexdigest()
+        cached = _cache_lookup(digest, quality)
+        if cached is not None:
+            cache_pdf, stats = cached
+            inc_used(key_type, key_value, m)
+            return FileResponse(
+                path=cache_pdf,
+                media_type="application/pdf",
+                filename=filename,
+                headers=_process_headers(stats, original_bytes, cache_pdf.stat().st_size),
+            )
 
         try:
-            stats = clean_pdf(str(inp), str(cleaned))
-            compress_with_ghostscript(str(cleaned), str(outp), quality)
+            # clean_pdf es CPU puro (pypdf) -> pool de procesos (el thread pool
+            # competiría por el GIL); Ghostscript va por el subprocess API
+            # asíncrono, así el event loop sigue aceptando requests. gs lee
+            # input.pdf del slot directamente (con -sPageList si hay blancas);
+            # solo la ruta de PDFs diminutos escribe el clean a disco.
+            loop = asyncio.get_running_loop()
+            if original_bytes < _GS_MIN_BYTES:
+                # PDF diminuto: el arranque de gs cuesta más de lo que puede
+                # ahorrar, así que devolvemos el resultado del clean tal cual.
+                cleaned_bytes, stats = await loop.run_in_executor(_CLEAN_POOL, clean_pdf_to_bytes, str(inp))
+                stats["compressor"] = "none"
+                if cleaned_bytes is None:
+                    outp = inp
+                else:
+                    outp.write_bytes(cleaned_bytes)
+                    del cleaned_bytes
+            else:
+                # Solo DETECCIÓN en el pool (sin re-serializar con PdfWriter):
+                # si hay blancas, gs recibe la lista vía -sPageList y hace el
+                # subset y la compresión en la misma pasada.
+                kept, stats = await loop.run_in_executor(_CLEAN_POOL, scan_blank_pages, str(inp))
+                stats["compressor"] = "ghostscript"
+                if quality == "printer" and kept is None:
+                    # Máxima calidad + nada que limpiar: gs casi siempre
+                    # devuelve un fichero igual o mayor, así que ni lo lanzamos.
+                    stats["compressor"] = "none"
+                    outp = inp
+                elif kept is None:
+                    await compress_with_ghostscript_async(inp, str(outp), quality)
+                    # Si gs lo ha ENGORDADO (PDFs ya optimizados), mejor el original
+                    if outp.exists() and outp.stat().st_size >= original_bytes:
+                        stats["compressor"] = "none"
+                        outp = inp
+                else:
+                    await compress_with_ghostscript_async(
+                        inp, str(outp), quality, page_list=build_page_list(kept)
+                    )
 
             if not outp.exists():
-                return HTMLResponse("❌ No se generó el archivo final.", status_code=500)
+                return PlainTextResponse("❌ No se generó el archivo final.", status_code=500)
 
-            data_out = outp.read_bytes()
-            final_bytes = len(data_out)
+            final_bytes = outp.stat().st_size
 
         except FileNotFoundError:
-            return HTMLResponse("❌ Error: Ghostscript no está disponible en el servidor.", status_code=500)
+            return PlainTextResponse("❌ Error: Ghostscript no está disponible en el servidor.", status_code=500)
         except Exception as e:
-            return HTMLResponse(f"❌ Error procesando el PDF:\n\n{e}", status_code=500)
-
-    # 5) % reducción
-    if original_bytes <= 0:
-        reduction_pct = 0.0
-    else:
-        reduction_pct = max(0.0, (1.0 - (final_bytes / original_bytes)) * 100.0)
+            return PlainTextResponse(f"❌ Error procesando el PDF:\n\n{e}", status_code=500)
 
-    # 6) Cuenta uso (solo si todo OK)
-    inc_used(key_type, key_value, m)
+        # 5) Guarda el resultado en la cache por contenido para futuros repeats
+        await asyncio.to_thread(_cache_store, outp, digest, quality, stats)
 
-    # 7) Respuesta (sin cache, sin historias)
-    headers = {
-        "Content-Disposition": f'attachment; filename="{filename}"',
-        "Cache-Control": "no-store",
-        "Pragma": "no-cache",
-        "X-Total-Pages": str(stats.get("total", "")),
-        "X-Removed-Pages": str(stats.get("removed", "")),
-        "X-Input-Bytes": str(original_bytes),
-        "X-Output-Bytes": str(final_bytes),
-        "X-Reduction-Pct": f"{reduction_pct:.1f}",
-    }
+        # 6) Cuenta uso (solo si todo OK)
+        inc_used(key_type, key_value, m)
 
-    return Response(
-        content=data_out,
-        media_type="application/pdf",
-        headers=headers,
-    )
+        # 7) Respuesta en streaming desde disco (sin cache HTTP, sin historias)
+        resp = FileResponse(
+            path=outp,
+            media_type="application/pdf",
+            filename=filename,
+            headers=_process_headers(stats, original_bytes, final_bytes),
+            background=BackgroundTask(_release_slot, tmpdir),
+        )
+        sent = True
+        return resp
+    finally:
+        # En cualquier salida temprana (413/500) devolvemos el slot aquí mismo
+        if not sent:
+            _clear_slot(tmpdir)
+            _TMP_POOL.put_nowait(tmpdir)
@@ -1,5 +1,7 @@
-import argparse
+import functools
+import io
 import os
+import re
 import shutil
 import subprocess
 import sys
@@ -13,6 +15,10 @@ from pypdf import PdfReader, PdfWriter
 # BLANK PAGE DETECTION (SAFE)
 # =========================
 
+# Primer byte no-blanco de un content stream, en C (motor de re) en vez de
+# strip(), que copia el stream entero solo para medirlo.
+_NONWS = re.compile(rb"\S")
+
 def _safe_extract_text(page) -> str:
     try:
         txt = page.extract_text() or ""
@@ -75,41 +81,47 @@ def is_probably_blank_page(page) -> bool:
     Heurística CONSERVADORA:
     Solo devuelve True si estamos muy seguros de que está vacía.
 
-    - Si hay texto extraíble -> NO es blanca
     - Si hay XObjects (imágenes/forms) -> NO es blanca
+    - Si hay texto extraíble -> NO es blanca
     - Si el content stream está vacío o casi vacío -> blanca
-    """
-    text = _safe_extract_text(page).strip()
-    if text:
-        return False
 
+    El check de XObjects va PRIMERO: es un lookup de diccionario, mientras
+    que extract_text interpreta el content stream entero (~100x más caro).
+    En PDFs escaneados (todo imágenes) corta sin extraer texto de nada.
+    """
     # Si hay imágenes/xobjects, NO borrar (aunque no haya texto extraíble)
     if _has_xobject_images_or_forms(page):
         return False
 
+    text = _safe_extract_text(page).strip()
+    if text:
+        return False
+
     data = _content_stream_bytes(page)
     if not data:
         return True
 
-    stripped = data.strip()
-    if len(stripped) == 0:
+    first = _NONWS.search(data)
+    if first is None:
         return True
 
     # Umbral conservador: si hay muy poco contenido en stream y no hay texto ni xobject,
     # normalmente es una página vacía o casi vacía.
     # (Si te pasas de agresivo aquí, borrarías contenido real.)
-    if len(stripped) < 30:
+    # Equivale a len(data.strip()) < 30 pero sin copiar el stream: si no hay
+    # ningún byte no-blanco 29 posiciones después del primero, el contenido
+    # "recortado" mide menos de 30.
+    if _NONWS.search(data, first.start() + 29) is None:
         return True
 
     return False
 
 
-def clean_pdf(input_path: str, output_path: str) -> dict:
+def clean_pages(reader: PdfReader):
     """
-    Limpia páginas "probablemente en blanco" (muy conservador).
+    Aplica la heurística de blancos y devuelve (writer, stats).
     Failsafe: si el resultado quedaría sin páginas, NO borra nada.
     """
-    reader = PdfReader(input_path)
     writer = PdfWriter()
 
     total = len(reader.pages)
@@ -131,20 +143,74 @@ def clean_pdf(input_path: str, output_path: str) -> dict:
         removed = 0
         kept_pages = total
 
+    return writer, {"total": total, "removed": removed, "remaining": kept_pages}
+
+
+def clean_pdf(input_path: str, output_path: str) -> dict:
+    """
+    Limpia páginas "probablemente en blanco" (muy conservador) y escribe
+    el resultado a disco.
+    """
+    writer, stats = clean_pages(PdfReader(input_path))
     with open(output_path, "wb") as f:
         writer.write(f)
+    return stats
+
+
+def scan_blank_pages(input_path: str):
+    """
+    Solo detección, sin PdfWriter: devuelve (kept, stats) donde kept es la
+    lista 1-based de páginas a conservar, o None si no hay nada que eliminar
+    (el llamante puede usar el fichero original tal cual). El servidor pasa
+    esa lista a Ghostscript vía -sPageList, así el subset y la compresión
+    salen de una sola re-serialización (la de gs) en vez de dos.
+
+    Mismo failsafe que clean_pages: si TODAS las páginas parecen blancas,
+    no se elimina ninguna.
+    """
+    reader = PdfReader(input_path)
+    total = len(reader.pages)
+    kept = [i + 1 for i, page in enumerate(reader.pages) if not is_probably_blank_page(page)]
+    removed = total - len(kept)
+    if removed == 0 or (not kept and total > 0):
+        return None, {"total": total, "removed": 0, "remaining": total}
+    return kept, {"total": total, "removed": removed, "remaining": len(kept)}
+
+
+def clean_pdf_to_bytes(input_path: str):
+    """
+    Como clean_pdf pero el resultado se queda en memoria: devuelve
+    (pdf_bytes | None, stats). Lo usa el servidor para pipear directo a
+    Ghostscript sin fichero intermedio.
 
-    return {"total": total, "removed": removed, "remaining": kept_pages}
+    None significa "no se eliminó ninguna página": el documento limpio
+    sería idéntico al original, así que nos ahorramos la re-serialización
+    de pypdf entera y el llamante puede usar el fichero de entrada tal cual.
+    """
+    writer, stats = clean_pages(PdfReader(input_path))
+    if stats["removed"] == 0:
+        return None, stats
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue(), stats
 
 
 # =========================
 # GHOSTSCRIPT
 # =========================
 
+# Timeout de seguridad para que no se quede colgado con PDFs raros (Render/servers)
+GS_TIMEOUT = 90
+
+
+@functools.lru_cache(maxsize=1)
 def find_ghostscript_exe() -> Optional[str]:
     """
     Busca Ghostscript en PATH. En Windows suele ser: gswin64c o gswin32c.
     En Mac/Linux: gs
+
+    Cacheado: el binario no se mueve en caliente y shutil.which recorre
+    PATH con un stat por candidato — eso no hay que pagarlo por request.
     """
     candidates = ["gs", "gswin64c", "gswin32c"]
     for c in candidates:
@@ -154,10 +220,29 @@ def find_ghostscript_exe() -> Optional[str]:
     return None
 
 
-def compress_with_ghostscript(input_pdf: str, output_pdf: str, quality: str) -> None:
+def build_page_list(pages: list) -> str:
     """
-    quality: screen | ebook | printer | prepress
-    Añadimos timeout para que no se quede colgado con PDFs raros.
+    Compacta una lista 1-based ordenada en la sintaxis de -sPageList de
+    Ghostscript: [1, 3, 5, 6, 7] -> "1,3,5-7".
+    """
+    parts = []
+    start = prev = pages[0]
+    for p in pages[1:]:
+        if p == prev + 1:
+            prev = p
+            continue
+        parts.append(f"{start}-{prev}" if prev > start else str(start))
+        start = prev = p
+    parts.append(f"{start}-{prev}" if prev > start else str(start))
+    return ",".join(parts)
+
+
+def build_gs_command(input_pdf: str, output_pdf: str, quality: str, page_list: Optional[str] = None) -> list:
+    """
+    Construye el comando Ghostscript completo (lo usa tanto la ruta síncrona
+    de aquí como la asíncrona del servidor). Con page_list, gs solo procesa
+    esas páginas (subset + compresión en una pasada). Lanza RuntimeError si
+    no hay gs.
     """
     gs = find_ghostscript_exe()
     if not gs:
@@ -175,19 +260,39 @@ def compress_with_ghostscript(input_pdf: str, output_pdf: str, quality: str) ->
         "-sDEVICE=pdfwrite",
         "-dCompatibilityLevel=1.4",
         f"-dPDFSETTINGS=/{quality}",
+        # Techos de memoria: más espacio de trabajo antes de ir a disco y un
+        # límite al bitmap en RAM, para que los PDFs escaneados grandes no
+        # disparen el RSS en servidores pequeños (Render). pdfwrite es
+        # mono-hilo, así que -dNumRenderingThreads no aplica aquí.
+        "-dBufferSpace=100000000",
+        "-dMaxBitmap=50000000",
         "-dNOPAUSE",
         "-dQUIET",
         "-dBATCH",
         f"-sOutputFile={output_pdf}",
         input_pdf,
     ]
+    if page_list:
+        cmd.insert(4, f"-sPageList={page_list}")
+    return cmd
+
+
+def compress_with_ghostscript(input_pdf: str, output_pdf: str, quality: str) -> None:
+    """
+    quality: screen | ebook | printer | prepress
+    Añadimos timeout para que no se quede colgado con PDFs raros.
+    """
+    cmd = build_gs_command(input_pdf, output_pdf, quality)
 
     try:
+        # Con -dQUIET el stdout va vacío: a /dev/null y sin modo texto, así
+        # no se paga pipe + decode por llamada (solo se decodifica stderr si
+        # de verdad hay error, y con replace por si la locale no es UTF-8).
         result = subprocess.run(
             cmd,
-            capture_output=True,
-            text=True,
-            timeout=90,   # ✅ seguridad (Render/servers)
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=GS_TIMEOUT,
         )
     except subprocess.TimeoutExpired:
         raise RuntimeError("Ghostscript tardó demasiado (timeout). Prueba con otra calidad o un PDF más pequeño.")
@@ -195,8 +300,7 @@ def compress_with_ghostscript(input_pdf: str, output_pdf: str, quality: str) ->
     if result.returncode != 0:
         raise RuntimeError(
             "Ghostscript falló al comprimir.\n"
-            f"STDERR:\n{result.stderr}\n"
-            f"STDOUT:\n{result.stdout}"
+            f"STDERR:\n{result.stderr.decode(errors='replace')}\n"
         )
 
 
@@ -205,10 +309,16 @@ def compress_with_ghostscript(input_pdf: str, output_pdf: str, quality: str) ->
 # =========================
 
 def file_size_kb(path: str) -> int:
-    return int(os.path.getsize(path) / 1024)
+    # Shift en vez de división float + int(): mismo resultado para tamaños
+    # no negativos, sin pasar por coma flotante.
+    return os.path.getsize(path) >> 10
 
 
 def main():
+    # Solo la CLI usa argparse; el servidor importa este módulo en cada
+    # arranque y no tiene por qué pagar ese import.
+    import argparse
+
     parser = argparse.ArgumentParser(description="PDF Cleaner & Compressor (MVP)")
     parser.add_argument("input", help="PDF de entrada (ej: input.pdf)")
     parser.add_argument("output", help="PDF de salida (ej: salida.pdf)")
@@ -235,7 +345,14 @@ def main():
         stats = clean_pdf(args.input, tmp_clean)
 
         if not args.compress:
-            shutil.copyfile(tmp_clean, args.output)
+            # Rename en vez de copiar: mover el fichero es una operación de
+            # metadatos, no re-leer y re-escribir todos los bytes. Si la
+            # salida cae en otro filesystem (tmpdir suele ser tmpfs),
+            # rename falla con EXDEV y caemos a la copia de siempre.
+            try:
+                os.replace(tmp_clean, args.output)
+            except OSError:
+                shutil.copyfile(tmp_clean, args.output)
             in_kb = file_size_kb(args.input)
             out_kb = file_size_kb(args.output)
             print(
@@ -1,85 +1,183 @@
 import sqlite3
+import threading
+from collections import defaultdict, namedtuple
 from pathlib import Path
 from datetime import date
 
 DB_PATH = Path("app.db")
 
+# =========
+# CONTADORES CALIENTES
+# =========
+# inc_used solo toca memoria; un flush periódico (lo programa app.py) vuelca
+# los deltas a SQLite. Trade-off: si el proceso muere perdemos unos pocos
+# incrementos del último intervalo — aceptable para un límite mensual, y a
+# cambio el path caliente deja de serializar en el write-lock de SQLite.
+_PENDING = defaultdict(int)  # (key_type, key_value, month) -> delta sin volcar
+_PENDING_LOCK = threading.Lock()
+_PENDING_MAX_KEYS = 50_000  # bound de memoria: al llegar aquí se fuerza un flush
+_PENDING_MAX_INCS = 256  # tras tantos incrementos acumulados, flush aunque haya pocas keys
+_pending_incs = 0  # incrementos desde el último flush (protegido por _PENDING_LOCK)
+
+
+# =========
+# CONEXIÓN COMPARTIDA
+# =========
+# Una sola conexión por proceso en lugar de abrir/cerrar por llamada:
+# nos ahorramos el open() + setup de journal por operación, y con WAL los
+# lectores ya no se bloquean con el escritor. Las operaciones van guardadas
+# por _CON_LOCK porque la conexión se comparte entre threads.
+_CON = None
+_CON_LOCK = threading.Lock()
+
+# SQL hoisted a constantes: strings con identidad estable, así la cache de
+# statements de sqlite3 (subida a 256 abajo) nunca re-parsea estas queries.
+_SQL_SAVE_TOKEN = "INSERT OR REPLACE INTO tokens(token, plan, email, created_at) VALUES(?,?,?,?)"
+_SQL_GET_TOKEN = "SELECT token, plan, email FROM tokens WHERE token=?"
+_SQL_GET_USED = "SELECT used FROM monthly_usage WHERE key_type=? AND key_value=? AND month=?"
+_SQL_UPSERT_USAGE = """
+    INSERT INTO monthly_usage(key_type, key_value, month, used)
+    VALUES(?,?,?,?)
+    ON CONFLICT(key_type, key_value, month)
+    DO UPDATE SET used = used + excluded.used
+"""
+
 
 def _connect():
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    return con
+    global _CON
+    if _CON is None:
+        with _CON_LOCK:
+            if _CON is None:
+                con = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+                con.row_factory = sqlite3.Row
+                con.execute("PRAGMA journal_mode=WAL")
+                con.execute("PRAGMA synchronous=NORMAL")
+                con.execute("PRAGMA temp_store=MEMORY")
+                con.execute("PRAGMA mmap_size=268435456")
+                con.execute("PRAGMA cache_size=-64000")  # 64 MB de page cache
+                con.execute("PRAGMA busy_timeout=5000")
+                _CON = con
+    return _CON
 
 
 def init_db():
     con = _connect()
-    cur = con.cursor()
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS tokens (
-            token TEXT PRIMARY KEY,
-            plan TEXT NOT NULL,
-            email TEXT DEFAULT '',
-            created_at TEXT NOT NULL
+    with _CON_LOCK:
+        con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tokens (
+                token TEXT PRIMARY KEY,
+                plan TEXT NOT NULL,
+                email TEXT DEFAULT '',
+                created_at TEXT NOT NULL
+            )
+            """
         )
-        """
-    )
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS monthly_usage (
-            key_type TEXT NOT NULL,
-            key_value TEXT NOT NULL,
-            month TEXT NOT NULL,
-            used INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY (key_type, key_value, month)
+
+        con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS monthly_usage (
+                key_type TEXT NOT NULL,
+                key_value TEXT NOT NULL,
+                month TEXT NOT NULL,
+                used INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (key_type, key_value, month)
+            )
+            """
         )
-        """
-    )
 
-    con.commit()
-    con.close()
+        con.commit()
 
 
 def save_token(token: str, plan: str, email: str):
     con = _connect()
-    con.execute(
-        "INSERT OR REPLACE INTO tokens(token, plan, email, created_at) VALUES(?,?,?,?)",
-        (token, plan, email or "", date.today().isoformat()),
-    )
-    con.commit()
-    con.close()
+    with _CON_LOCK:
+        con.execute(
+            _SQL_SAVE_TOKEN,
+            (token, plan, email or "", date.today().isoformat()),
+        )
+        con.commit()
+
+
+# Resultado de get_token: namedtuple en vez de dict — más ligero de construir
+# y de cachear (app.py guarda estos objetos en su LRU de tokens), con acceso
+# por atributo (row.plan) en lugar de lookup por string.
+Token = namedtuple("Token", ["token", "plan", "email"])
 
 
 def get_token(token: str):
     con = _connect()
-    row = con.execute("SELECT token, plan, email FROM tokens WHERE token=?", (token,)).fetchone()
-    con.close()
-    return dict(row) if row else None
+    with _CON_LOCK:
+        cur = con.cursor()
+        cur.row_factory = None
+        row = cur.execute(_SQL_GET_TOKEN, (token,)).fetchone()
+    return Token._make(row) if row else None
 
 
 def get_used(key_type: str, key_value: str, month: str) -> int:
     con = _connect()
-    row = con.execute(
-        "SELECT used FROM monthly_usage WHERE key_type=? AND key_value=? AND month=?",
-        (key_type, key_value, month),
-    ).fetchone()
-    con.close()
-    return int(row["used"]) if row else 0
+    with _CON_LOCK:
+        # Query de una sola columna en el path caliente: el row_factory se
+        # apaga en el cursor para recibir la tupla cruda de sqlite3 sin
+        # construir un objeto Row por fila (la conexión sigue con Row para
+        # el resto de queries).
+        cur = con.cursor()
+        cur.row_factory = None
+        row = cur.execute(
+            _SQL_GET_USED,
+            (key_type, key_value, month),
+        ).fetchone()
+
+    base = int(row[0]) if row else 0
+    with _PENDING_LOCK:
+        delta = _PENDING.get((key_type, key_value, month), 0)
+    return base + delta
 
 
 def inc_used(key_type: str, key_value: str, month: str):
+    global _pending_incs
+    key = (key_type, key_value, month)
+    with _PENDING_LOCK:
+        _PENDING[key] += 1
+        _pending_incs += 1
+        needs_flush = (
+            len(_PENDING) >= _PENDING_MAX_KEYS or _pending_incs >= _PENDING_MAX_INCS
+        )
+    if needs_flush:
+        flush_usage()
+
+
+def flush_usage():
+    """
+    Vuelca los deltas pendientes a SQLite en una sola transacción.
+    Lo llama app.py cada pocos segundos y en shutdown.
+    """
+    global _pending_incs
+    with _PENDING_LOCK:
+        if not _PENDING:
+            return
+        pending = dict(_PENDING)
+        _PENDING.clear()
+        _pending_incs = 0
+
     con = _connect()
-    cur = con.cursor()
-    cur.execute(
-        """
-        INSERT INTO monthly_usage(key_type, key_value, month, used)
-        VALUES(?,?,?,1)
-        ON CONFLICT(key_type, key_value, month)
-        DO UPDATE SET used = used + 1
-        """,
-        (key_type, key_value, month),
-    )
-    con.commit()
-    con.close()
+    rows = [
+        (key_type, key_value, month, delta)
+        for (key_type, key_value, month), delta in pending.items()
+    ]
+    try:
+        with _CON_LOCK:
+            # executemany: un solo statement preparado y el bucle de binds en C,
+            # en vez de un round-trip por la API de Python por cada key.
+            con.executemany(_SQL_UPSERT_USAGE, rows)
+            con.commit()
+    except Exception:
+        # Si el volcado falla (p.ej. busy_timeout agotado), los deltas ya
+        # sacados del buffer volverían a la nada: se re-mergean en _PENDING
+        # para que el siguiente intervalo los reintente. Sumar (no asignar)
+        # respeta los incrementos que hayan entrado mientras tanto.
+        with _PENDING_LOCK:
+            for key, delta in pending.items():
+                _PENDING[key] += delta
+            _pending_incs += sum(pending.values())
+        raise
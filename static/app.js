@@ -0,0 +1,192 @@
+function fmtBytes(bytes){
+  const units = ["B","KB","MB","GB"];
+  let i = 0;
+  let n = Number(bytes || 0);
+  while(n >= 1024 && i < units.length-1){ n /= 1024; i++; }
+  return `${n.toFixed(i === 0 ? 0 : 2)} ${units[i]}`;
+}
+
+// Nodos del DOM resueltos UNA vez (script va con defer, el DOM ya existe):
+// cada getElementById repetido en el submit era un paseo por el id-map.
+const el = Object.fromEntries(
+  ["pdfForm", "submitBtn", "status", "result", "downloadLink"]
+    .map(id => [id, document.getElementById(id)])
+);
+el.fileInput = document.querySelector('#pdfForm input[name="file"]');
+
+// Sniff de magic bytes en el cliente: un fichero renombrado a .pdf se
+// rechaza aquí sin gastar el upload entero (el servidor repite el check).
+const _fileInput = el.fileInput;
+if(_fileInput){
+  _fileInput.addEventListener("change", async () => {
+    const f = _fileInput.files && _fileInput.files[0];
+    if(!f) return;
+    const status = el.status;
+    // Content-type declarado por el SO: si existe y no es PDF, fuera ya
+    // (sin leer ni un byte del fichero).
+    if(f.type && f.type !== "application/pdf"){
+      _fileInput.value = "";
+      status.innerHTML = `<span class="danger">Solo se aceptan PDFs.</span>`;
+      return;
+    }
+    const head = new Uint8Array(await f.slice(0, 5).arrayBuffer());
+    if(String.fromCharCode(...head) !== "%PDF-"){
+      _fileInput.value = "";
+      status.innerHTML = `<span class="danger">El archivo no parece un PDF válido.</span>`;
+    }else{
+      status.textContent = "";
+    }
+  });
+}
+
+// Upload por XMLHttpRequest: fetch no expone el progreso de SUBIDA, y con
+// PDFs de varios MB en móvil el spinner mudo parecía un cuelgue. Devuelve un
+// objeto con la misma forma que usa handleSubmit (ok/status/headers/blob).
+// El timeout va POR ENCIMA del GS_TIMEOUT del servidor (90 s): si abortamos
+// antes que él, una compresión lenta pero buena se pierde ya enviada.
+function xhrUpload(fd, onProgress, timeoutMs = 120000){
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open("POST", "/process");
+    xhr.responseType = "blob";
+    xhr.timeout = timeoutMs;
+    xhr.upload.onprogress = e => {
+      if(e.lengthComputable && onProgress) onProgress(e.loaded / e.total);
+    };
+    xhr.onload = () => resolve({
+      ok: xhr.status < 400,
+      status: xhr.status,
+      headers: { get: name => xhr.getResponseHeader(name) },
+      blob: () => Promise.resolve(xhr.response),
+      text: () => xhr.response.text()
+    });
+    xhr.onerror = () => reject(new Error("network"));
+    xhr.ontimeout = () => {
+      const err = new Error("timeout");
+      err.name = "AbortError";
+      reject(err);
+    };
+    xhr.send(fd);
+  });
+}
+
+// POST con timeout y reintentos con backoff: un 502 transitorio o un error
+// de red no dejan el spinner girando para siempre. OJO: el timeout NO se
+// reintenta — si el servidor sigue procesando (Ghostscript puede tardar
+// hasta su propio timeout), re-subir el PDF duplicaría el trabajo y cada
+// pasada completada descuenta cuota aunque el socket ya esté muerto.
+async function postWithRetry(fd, onProgress, attempts = 3){
+  for(let i = 0; i < attempts; i++){
+    try{
+      const res = await xhrUpload(fd, onProgress);
+      if(res.status >= 500 && i < attempts - 1){
+        await new Promise(r => setTimeout(r, 500 * 2 ** i));
+        continue;
+      }
+      return res;
+    }catch(e){
+      if(e && e.name === "AbortError") throw e;
+      if(i === attempts - 1) throw e;
+      await new Promise(r => setTimeout(r, 500 * 2 ** i));
+    }
+  }
+}
+
+// Flag síncrono contra el doble submit (doble click, Enter repetido):
+// btn.disabled no cubre el hueco hasta que el navegador repinta.
+let inFlight = false;
+
+async function handleSubmit(ev){
+  ev.preventDefault();
+  if(inFlight) return;
+  inFlight = true;
+
+  const form = el.pdfForm;
+  const btn = el.submitBtn;
+  const status = el.status;
+  const result = el.result;
+  const download = el.downloadLink;
+
+  // reset UI
+  result.classList.add("hidden");
+  download.classList.add("hidden");
+  download.href = "#";
+  download.textContent = "";
+
+  // botón loading
+  btn.disabled = true;
+  btn.style.opacity = "0.8";
+  btn.innerHTML = `<span class="spinner"></span> Procesando…`;
+  status.textContent = ""; // ✅ no queremos “procesando” abajo, solo en el botón
+
+  try{
+    const fd = new FormData(form);
+
+    const res = await postWithRetry(fd, frac => {
+      const pct = Math.round(frac * 100);
+      btn.innerHTML = pct < 100
+        ? `<span class="spinner"></span> Subiendo… ${pct}%`
+        : `<span class="spinner"></span> Procesando…`;
+    });
+
+    if(!res.ok){
+      const txt = await res.text();
+      // En los 429 el servidor manda Retry-After: lo traducimos a un
+      // "vuelve en X" en vez de dejar solo el texto genérico.
+      let extra = "";
+      if(res.status === 429){
+        const ra = parseInt(res.headers.get("retry-after") || "0", 10);
+        if(ra >= 86400) extra = ` Vuelve en ${Math.ceil(ra / 86400)} día(s).`;
+        else if(ra >= 3600) extra = ` Vuelve en ${Math.ceil(ra / 3600)} hora(s).`;
+        else if(ra > 0) extra = ` Reintenta en ${Math.ceil(ra / 60)} minuto(s).`;
+      }
+      status.innerHTML = `<span class="danger">Error:</span> ${txt}${extra}`;
+      return;
+    }
+
+    const inBytes = res.headers.get("x-input-bytes");
+    const outBytes = res.headers.get("x-output-bytes");
+    const reduction = res.headers.get("x-reduction-pct");
+    const totalPages = res.headers.get("x-total-pages");
+    const removedPages = res.headers.get("x-removed-pages");
+
+    const blob = await res.blob();
+    const url = URL.createObjectURL(blob);
+
+    // filename
+    let filename = "output.pdf";
+    const cd = res.headers.get("content-disposition") || "";
+    const m = cd.match(/filename="([^"]+)"/);
+    if(m && m[1]) filename = m[1];
+
+    download.href = url;
+    download.download = filename;
+    download.textContent = `⬇️ Descargar ${filename}`;
+    download.classList.remove("hidden");
+
+    // resultado minimal + tick verde
+    const parts = [];
+    if(reduction !== null) parts.push(`<span class="check">✓</span> <b>Reducción:</b> <span class="ok">${reduction}%</span>`);
+    if(inBytes !== null && outBytes !== null){
+      parts.push(`<b>Tamaño:</b> ${fmtBytes(inBytes)} → ${fmtBytes(outBytes)}`);
+    }
+    if(totalPages) parts.push(`<b>Páginas:</b> ${totalPages}${removedPages ? ` (quitadas: ${removedPages})` : ""}`);
+
+    result.innerHTML = parts.join("<br>");
+    result.classList.remove("hidden");
+
+    status.innerHTML = `<span class="ok">Listo.</span>`;
+
+  }catch(e){
+    if(e && e.name === "AbortError"){
+      status.innerHTML = `<span class="danger">El servidor tardó demasiado. Inténtalo de nuevo.</span>`;
+    }else{
+      status.innerHTML = `<span class="danger">Error:</span> ${e}`;
+    }
+  }finally{
+    inFlight = false;
+    btn.disabled = false;
+    btn.style.opacity = "1";
+    btn.innerHTML = `Procesar`;
+  }
+}